@@ -1,19 +1,16 @@
 import os
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
-from typing import List
+from typing import Callable, List, Optional
 
 from langchain_community.llms import Replicate    # importing from langchain depricated; use langchain_community for several modules here
-from langchain_community.document_loaders import OnlinePDFLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import FAISS
-from langchain_community.embeddings import CohereEmbeddings
-from langchain_community.retrievers import BM25Retriever
-from langchain.retrievers import EnsembleRetriever
 from langchain.retrievers import ContextualCompressionRetriever
 from langchain.retrievers.document_compressors import CohereRerank
 from langchain.prompts import ChatPromptTemplate
 from langchain.schema import StrOutputParser
 from langchain_core.runnables import RunnableParallel, RunnablePassthrough
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from rag_utils import ParallelEnsembleRetriever, build_retrievers, get_default_embed_func, get_default_llm, get_default_reranker, load_pdf
 
 
 class ElevatedRagChain:
@@ -27,43 +24,56 @@ class ElevatedRagChain:
     and passed through a Cohere reranker before being used as context
     for generating answers using a Llama 2 large language model (LLM). 
     '''
-    def __init__(self) -> None:
+    def __init__(
+            self,
+            embed_func: Optional[Embeddings] = None,
+            llm: Optional[Replicate] = None,
+            reranker: Optional[CohereRerank] = None,
+            pdf_loader: Optional[Callable[[str], Document]] = None,
+            ) -> None:
         '''
         Initialize the class with predefined model, embedding function, weights, and top_k value
+        Args:
+            embed_func (Embeddings, optional): shared embedding function, created if not provided
+            llm (Replicate, optional): shared Llama 2 model client, created if not provided
+            reranker (CohereRerank, optional): shared Cohere reranker client, created if not provided
+            pdf_loader (Callable, optional): function loading a single PDF document from its URL, defaults to load_pdf
         '''
-        self.llama2_70b   = 'meta/llama-2-70b-chat:2d19859030ff705a87c746f7e96eea03aefb71f166725aee39692f1476566d48'
-        self.embed_func   = CohereEmbeddings(model="embed-english-light-v3.0")
+        self.embed_func   = embed_func if embed_func is not None else get_default_embed_func()
+        self.llm          = llm if llm is not None else get_default_llm()
+        self.reranker     = reranker if reranker is not None else get_default_reranker()
+        self.pdf_loader   = pdf_loader if pdf_loader is not None else load_pdf
         self.bm25_weight  = 0.6
         self.faiss_weight = 0.4
         self.top_k        = 5
+        self.fetch_k      = 20    # number of FAISS candidates MMR selects top_k diverse chunks from
 
 
     def add_pdfs_to_vectore_store(
             self,
             pdf_links: List,
             chunk_size: int=1500,
+            progress_callback: Optional[Callable[[int, int], None]]=None,
             ) -> None:
         '''
         Processes PDF documents by loading, chunking, embedding, and adding them to a FAISS vector store.
+        BM25 retriever and FAISS vector store are cached on disk and reused for the same PDFs.
         Build an advanced RAG system  
         Args:
             pdf_links (List): list of URLs pointing to the PDF documents to be processed
             chunk_size (int, optional): size of text chunks to split the documents into, defaults to 1500
+            progress_callback (Callable, optional): called with (number of loaded PDFs, total number of PDFs)
+                each time a PDF finishes loading
         '''        
-        # load pdfs
-        self.raw_data = [ OnlinePDFLoader(doc).load()[0] for doc in pdf_links ]
-
-        # chunk text
-        self.text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=100)
-        self.split_data    = self.text_splitter.split_documents(self.raw_data)
-
-        # add chunks to BM25 retriever
-        self.bm25_retriever   = BM25Retriever.from_documents(self.split_data)
+        # load, chunk, and index pdfs, or reuse the retrievers cached for the same pdfs
+        self.bm25_retriever, self.vector_store, self.split_data = build_retrievers(
+            pdf_links, chunk_size, self.embed_func, self.pdf_loader, progress_callback,
+        )
         self.bm25_retriever.k = self.top_k
-
-        # embed and add chunks to vectore store
-        self.vector_store     = FAISS.from_documents(self.split_data, self.embed_func)
-        self.faiss_retriever  = self.vector_store.as_retriever(search_kwargs={"k": self.top_k})
+        self.faiss_retriever  = self.vector_store.as_retriever(    # MMR drops near-duplicate chunks before reranking
+            search_type="mmr",
+            search_kwargs={"k": self.top_k, "fetch_k": self.fetch_k, "lambda_mult": 0.5},
+        )
         print("All PDFs processed and added to vectore store.")
         
         # build advanced RAG system
@@ -78,14 +88,13 @@ class ElevatedRagChain:
         * FAISS vector store retriever
         * Llama 2 model
         '''
-        # combine BM25 and FAISS retrievers into an ensemble retriever
-        self.ensemble_retriever = EnsembleRetriever(
+        # combine BM25 and FAISS retrievers into an ensemble retriever that queries them concurrently
+        self.ensemble_retriever = ParallelEnsembleRetriever(
             retrievers=[self.bm25_retriever, self.faiss_retriever],
             weights=[self.bm25_weight, self.faiss_weight]
         )
 
         # use reranker to improve retrieval quality
-        self.reranker = CohereRerank(top_n=5)
         self.rerank_retriever = ContextualCompressionRetriever(    # combine ensemble retriever and reranker
             base_retriever=self.ensemble_retriever,
             base_compressor=self.reranker,
@@ -114,11 +123,5 @@ class ElevatedRagChain:
             }
         )
 
-        # initialize Llama 2 model with specific parameters
-        self.llm = Replicate(
-            model=self.llama2_70b,
-            model_kwargs={"temperature": 0.5,"top_p": 1, "max_new_tokens":1000}
-        )
-
         # chain components to form final elevated RAG system using LangChain Expression Language (LCEL)
         self.elevated_rag_chain = self.entry_point_and_elevated_retriever | self.rag_prompt | self.llm #| self.str_output_parser
@@ -1,16 +1,41 @@
 import os
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
-from typing import List
+from threading import Thread
+from typing import Callable, Iterator, List, Optional
 from langchain_community.llms import Replicate    # importing from langchain depricated; use langchain_community for several modules here
-from langchain_community.document_loaders import OnlinePDFLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import FAISS
-from langchain_community.embeddings import CohereEmbeddings
-from langchain_community.retrievers import BM25Retriever
-from langchain.retrievers import EnsembleRetriever
 from langchain.retrievers import ContextualCompressionRetriever
 from langchain.retrievers.document_compressors import CohereRerank
 from langchain.chains import ConversationalRetrievalChain
+from langchain.memory import ConversationSummaryBufferMemory
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from rag_utils import ParallelEnsembleRetriever, QueueCallbackHandler, build_retrievers, get_default_embed_func, get_default_llm, get_default_reranker, load_pdf
+
+
+class CharBudgetSummaryBufferMemory(ConversationSummaryBufferMemory):
+    '''
+    ConversationSummaryBufferMemory that estimates the size of the chat history as
+    number of characters / chars_per_token instead of running a tokenizer on every turn.
+    Older messages are pruned and summarized only when the estimated token count
+    exceeds max_token_limit, so short chats never trigger a summarization LLM call.
+    '''
+    chars_per_token: int = 4
+
+    def prune(self) -> None:
+        '''
+        Prune buffer if it exceeds max token limit (estimated from the character count)
+        '''
+        buffer = self.chat_memory.messages
+        buffer_chars = sum(len(message.content) for message in buffer)
+        if buffer_chars / self.chars_per_token <= self.max_token_limit:
+            return
+        n_pruned = 0
+        while n_pruned < len(buffer) and buffer_chars / self.chars_per_token > self.max_token_limit:
+            buffer_chars -= len(buffer[n_pruned].content)    # drop oldest messages first
+            n_pruned += 1
+        pruned_memory = buffer[:n_pruned]
+        del buffer[:n_pruned]    # remove pruned messages in one slice instead of repeated pop(0)
+        self.moving_summary_buffer = self.predict_new_summary(pruned_memory, self.moving_summary_buffer)
 
 
 class ElevatedRagWithHistory:
@@ -26,43 +51,62 @@ class ElevatedRagWithHistory:
     The previous chat history is used to re-phrase the user query in order to levarage
     the past reponses provided by the LLM.
     '''
-    def __init__(self) -> None:
+    def __init__(
+            self,
+            embed_func: Optional[Embeddings] = None,
+            llm: Optional[Replicate] = None,
+            streaming_llm: Optional[Replicate] = None,
+            reranker: Optional[CohereRerank] = None,
+            pdf_loader: Optional[Callable[[str], Document]] = None,
+            ) -> None:
         '''
         Initialize the class with predefined model, embedding function, weights, and top_k value
+        Args:
+            embed_func (Embeddings, optional): shared embedding function, created if not provided
+            llm (Replicate, optional): shared Llama 2 model client, created if not provided
+            streaming_llm (Replicate, optional): shared Llama 2 model client with streaming enabled,
+                used to generate answers, created if not provided
+            reranker (CohereRerank, optional): shared Cohere reranker client, created if not provided
+            pdf_loader (Callable, optional): function loading a single PDF document from its URL, defaults to load_pdf
         '''
-        self.llama2_70b   = 'meta/llama-2-70b-chat:2d19859030ff705a87c746f7e96eea03aefb71f166725aee39692f1476566d48'
-        self.embed_func   = CohereEmbeddings(model="embed-english-light-v3.0")
+        self.embed_func   = embed_func if embed_func is not None else get_default_embed_func()
+        self.llm          = llm if llm is not None else get_default_llm()
+        self.streaming_llm = streaming_llm if streaming_llm is not None else get_default_llm(streaming=True)
+        self.reranker     = reranker if reranker is not None else get_default_reranker()
+        self.pdf_loader   = pdf_loader if pdf_loader is not None else load_pdf
         self.bm25_weight  = 0.6
         self.faiss_weight = 0.4
         self.top_k        = 5
+        self.fetch_k      = 20    # number of FAISS candidates MMR selects top_k diverse chunks from
+        self.history_token_limit = 1500    # max tokens of chat history kept verbatim before summarizing
+        self.chain_thread = None    # background thread running the chain of the last streamed query
 
 
     def add_pdfs_to_vectore_store(
             self,
             pdf_links: List,
             chunk_size: int=1500,
+            progress_callback: Optional[Callable[[int, int], None]]=None,
             ) -> None:
         '''
         Processes PDF documents by loading, chunking, embedding, and adding them to a FAISS vector store.
+        BM25 retriever and FAISS vector store are cached on disk and reused for the same PDFs.
         Build an advanced RAG system  
         Args:
             pdf_links (List): list of URLs pointing to the PDF documents to be processed
             chunk_size (int, optional): size of text chunks to split the documents into, defaults to 1500
+            progress_callback (Callable, optional): called with (number of loaded PDFs, total number of PDFs)
+                each time a PDF finishes loading
         '''        
-        # load pdfs
-        self.raw_data = [ OnlinePDFLoader(doc).load()[0] for doc in pdf_links ]
-
-        # chunk text
-        self.text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=100)
-        self.split_data    = self.text_splitter.split_documents(self.raw_data)
-
-        # add chunks to BM25 retriever
-        self.bm25_retriever   = BM25Retriever.from_documents(self.split_data)
+        # load, chunk, and index pdfs, or reuse the retrievers cached for the same pdfs
+        self.bm25_retriever, self.vector_store, self.split_data = build_retrievers(
+            pdf_links, chunk_size, self.embed_func, self.pdf_loader, progress_callback,
+        )
         self.bm25_retriever.k = self.top_k
-
-        # embed and add chunks to vectore store
-        self.vector_store     = FAISS.from_documents(self.split_data, self.embed_func)
-        self.faiss_retriever  = self.vector_store.as_retriever(search_kwargs={"k": self.top_k})
+        self.faiss_retriever  = self.vector_store.as_retriever(    # MMR drops near-duplicate chunks before reranking
+            search_type="mmr",
+            search_kwargs={"k": self.top_k, "fetch_k": self.fetch_k, "lambda_mult": 0.5},
+        )
         print("All PDFs processed and added to vectore store.")
         
         # build advanced RAG system
@@ -78,30 +122,37 @@ class ElevatedRagWithHistory:
         * Chat history
         * Llama 2 model 
         '''
-        # combine BM25 and FAISS retrievers into an ensemble retriever
-        self.ensemble_retriever = EnsembleRetriever(
+        # combine BM25 and FAISS retrievers into an ensemble retriever that queries them concurrently
+        self.ensemble_retriever = ParallelEnsembleRetriever(
             retrievers=[self.bm25_retriever, self.faiss_retriever],
             weights=[self.bm25_weight, self.faiss_weight]
         )
 
         # use reranker to improve retrieval quality
-        self.reranker = CohereRerank(top_n=5)
         self.rerank_retriever = ContextualCompressionRetriever(    # combine ensemble retriever and reranker
             base_retriever=self.ensemble_retriever,
             base_compressor=self.reranker,
         )
 
-        # initialize Llama 2 model with specific parameters
-        self.llm = Replicate(
-            model=self.llama2_70b,
-            model_kwargs={"temperature": 0.5,"top_p": 1, "max_new_tokens":1000}
+        # initialize chat history memory: older turns are summarized by the LLM,
+        # the most recent turns are kept verbatim within the token limit (~4 chars per token)
+        self.memory = CharBudgetSummaryBufferMemory(
+            llm=self.llm,
+            max_token_limit=self.history_token_limit,
+            memory_key="chat_history",
+            return_messages=True,
+            output_key="answer",
         )
-                       
-        # initialize RAG chain with chat history
-        self.chat_history = []
+
+        # initialize RAG chain with chat history; only the answer is generated by the streaming LLM,
+        # so that tokens of the rephrased question are not streamed to the user.
+        # On the first turn memory returns an empty chat history, and the chain passes the user query
+        # to the retriever as is, without the LLM call rephrasing it
         self.chain = ConversationalRetrievalChain.from_llm(
-            self.llm,
+            self.streaming_llm,
             self.rerank_retriever,
+            condense_question_llm=self.llm,
+            memory=self.memory,
             return_source_documents=True,
         )
 
@@ -110,9 +161,9 @@ class ElevatedRagWithHistory:
         '''
         Process user query through RAG system, leveraging chat history:
         * take user query as input;
-        * passes it along with the accumulated chat history to the ConversationalRetrievalChain;
-        * appends query and response to chat history;
-        * keep chat history manageable and relevant by retaining only the last 5 interactions.
+        * passes it to the ConversationalRetrievalChain which loads the accumulated chat history from memory;
+        * memory appends query and response to chat history;
+        * memory keeps chat history manageable by summarizing older interactions once the token limit is exceeded.
 
         Args:
             query (str): user's query to be processed by RAG system.
@@ -120,10 +171,49 @@ class ElevatedRagWithHistory:
         Returns:
             str: generated answer to user's query.
         '''
+        # wait until chat history of the last streamed query is saved
+        if self.chain_thread is not None:
+            self.chain_thread.join()
         # process query + chat history through RAG system
-        result = self.chain({"question": query, "chat_history": self.chat_history})
-        self.chat_history.append((query, result["answer"]))    # update chat history
-        if len(self.chat_history) > 5:    # keep the most recent 5 turns in chat history
-            self.chat_history = self.chat_history[-5:]
+        result = self.chain({"question": query})    # chat history is loaded from and saved to memory
         return result['answer']    # return response generated by LLM
-        
\ No newline at end of file
+
+
+    def stream(self, query: str) -> Iterator[str]:
+        '''
+        Process user query through RAG system in the same way as invoke, but yield the tokens
+        of the answer as soon as the LLM generates them. The chain runs in a background thread
+        and sends the tokens through a queue. The stream ends as soon as the answer is generated;
+        saving the query and answer to memory (which may call the LLM to summarize older interactions)
+        finishes in the background, and the next query waits for it.
+
+        Args:
+            query (str): user's query to be processed by RAG system.
+
+        Yields:
+            str: next token of the generated answer to user's query.
+        '''
+        chain   = self.chain    # fail early if RAG system is not built yet
+        handler = QueueCallbackHandler()
+        errors  = []
+
+        def run_chain() -> None:
+            try:
+                chain({"question": query}, callbacks=[handler])
+            except Exception as e:
+                if handler.answer_done:    # answer is already streamed, only saving chat history failed
+                    print(f"Could not save chat history: {e}")
+                else:    # re-raised in the consumer thread below
+                    errors.append(e)
+            finally:
+                handler.queue.put(None)    # signal end of stream if the answer did not end it
+
+        # wait until chat history of the last streamed query is saved
+        if self.chain_thread is not None:
+            self.chain_thread.join()
+        self.chain_thread = Thread(target=run_chain, daemon=True)
+        self.chain_thread.start()
+        while (token := handler.queue.get()) is not None:
+            yield token
+        if errors:
+            raise errors[0]
@@ -0,0 +1,183 @@
+from typing import Any, Callable, Iterator
+
+import streamlit as st
+from langchain_community.llms import Replicate
+from langchain.retrievers.document_compressors import CohereRerank
+from langchain_core.embeddings import Embeddings
+from rag_utils import get_default_embed_func, get_default_llm, get_default_reranker
+
+
+@st.cache_resource
+def get_embed_func() -> Embeddings:
+    '''
+    Create the Cohere embedding function once and share it across reruns, sessions, and pages
+    '''
+    return get_default_embed_func()
+
+
+@st.cache_resource
+def get_llm(streaming: bool = False) -> Replicate:
+    '''
+    Create the Llama 2 model client once per streaming mode and share it across reruns, sessions, and pages
+    '''
+    return get_default_llm(streaming=streaming)
+
+
+@st.cache_resource
+def get_reranker() -> CohereRerank:
+    '''
+    Create the Cohere reranker client once and share it across reruns, sessions, and pages
+    '''
+    return get_default_reranker()
+
+
+@st.cache_data(max_entries=32)
+def calculate_text_area_height(
+        text: str,
+        chars_per_line: int = 70,
+        default_height: int = 100,
+        line_height: int = 27,
+        ) -> int:
+    '''
+    Calculate dynamic height of text area widget based on its content.
+    Results are cached, so reruns with the same response do not recompute the height.
+    Args:
+        text (str): text content to display in the text area.
+        chars_per_line (int): estimated number of characters per line, defaults to 70.
+        default_height (int): minimum height of the text area, defaults to 100.
+        line_height (int): height per line of text, defaults to 27.
+    Returns:
+        int: calculated height of text area
+    '''
+    lines = text.count('\n') + 1    # count number of lines in text
+    estimated_lines = max(lines, -(-len(text) // chars_per_line))    # estimate based on content length (ceil division)
+    return max(default_height, int(estimated_lines * line_height))    # calculate dynamic height
+
+
+@st.cache_resource
+def get_background_css(color: str) -> str:
+    '''
+    Build custom CSS changing the background color of the Streamlit app
+    Args:
+        color (str): background color, e.g. hex code
+    Returns:
+        str: custom CSS
+    '''
+    return f"""
+    <style>
+    /* Target the root html and body elements along with the main Streamlit container classes */
+    html, body, [class*="ViewContainer"], [class*="stApp"]  {{
+        background-color: {color};
+    }}
+    </style>
+    """
+
+
+def change_background_color(color: str) -> None:
+    '''
+    Inject custom CSS to change the background color of the Streamlit app
+    Favorite colors:
+    * #ADD8E6, #BEEEFF, #CEEFFF, #DEFFFF - light blue
+    * #CCE0F5 - light cornflower blue
+    Args:
+        color (str): background color, e.g. hex code
+    '''
+    st.markdown(get_background_css(color), unsafe_allow_html=True)    # inject custom CSS
+
+
+def pdf_loader_ui(rag_chain: Any) -> None:
+    '''
+    Render input area for PDF URLs and `Load PDFs` button; load PDFs into RAG system when the button is clicked
+    Args:
+        rag_chain (Any): RAG system instance providing add_pdfs_to_vectore_store method
+    '''
+    # input area for PDF URLs
+    pdf_urls = st.text_area("Enter PDF URLs (one per line):", height=100)
+    load_pdfs_button = st.button("Load PDFs")
+
+    # load PDFs into vector store
+    if load_pdfs_button:
+        if not pdf_urls.strip():
+            st.warning("Please enter one or more PDF URLs before loading.")
+        else:
+            try:
+                with st.spinner("Loading..."):
+                    # strip whitespace, drop blank lines and duplicate URLs, keep original order
+                    pdf_urls_list = list(dict.fromkeys(url.strip() for url in pdf_urls.splitlines() if url.strip()))
+                    progress_bar = st.progress(0, text="Loading PDFs...")
+                    rag_chain.add_pdfs_to_vectore_store(
+                        pdf_urls_list,
+                        progress_callback=lambda done, total: progress_bar.progress(
+                            done / total, text=f"Loaded {done} of {total} PDFs"
+                        ),
+                    )
+                    st.success("PDFs loaded successfully!")
+            except ValueError:
+                st.warning("Could not load PDFs. Make sure your PDF URLs are valid.")
+            except Exception as e:
+                st.warning("Could not load PDFs. Make sure you are uploading valid PDF files")
+                print(e)
+
+
+def handle_query_submission(
+        query_key: str,
+        response_key: str,
+        stream_response: Callable[[str], Iterator[str]],
+        is_ready: Callable[[], bool],
+        ) -> None:
+    '''
+    Handle submission of user query:
+    * validate query
+    * perform query operation, streaming response tokens to the page as they are generated
+    * update session state with response to query
+    * display error message if query is empty or if RAG system encounters an issue
+    Args:
+        query_key (str): session state key of the user query
+        response_key (str): session state key of the response to the user query
+        stream_response (Callable): function returning an iterator over response tokens for the user query
+        is_ready (Callable): function returning whether the RAG system has been built
+    '''
+    # validate query is not empty
+    if not st.session_state[query_key].strip():
+        st.error("Please enter a non-empty query")
+        return
+    # handle cases where RAG system is not built yet
+    if not is_ready():
+        st.error("RAG system is not ready. Please load PDFs.")
+        return
+    # perform query operation and update session state with response
+    with st.spinner("Querying the Llama RAG system ..."):
+        response_placeholder = st.empty()
+        with response_placeholder.container():
+            response = st.write_stream(stream_response(st.session_state[query_key]))
+        response_placeholder.empty()    # streamed text is replaced by the response field
+        st.session_state[response_key] = response
+
+
+def query_ui(
+        page: str,
+        query_key: str,
+        response_key: str,
+        stream_response: Callable[[str], Iterator[str]],
+        is_ready: Callable[[], bool],
+        ) -> None:
+    '''
+    Render user query input, `Submit Query` button, and response field
+    Args:
+        page (str): identifier of the current page, e.g. 'page1'
+        query_key (str): session state key of the user query
+        response_key (str): session state key of the response to the user query
+        stream_response (Callable): function returning an iterator over response tokens for the user query
+        is_ready (Callable): function returning whether the RAG system has been built
+    '''
+    # input and submit user query
+    st.text_input("Enter your query:", key=query_key)
+    if st.button("Submit Query"):
+        handle_query_submission(query_key, response_key, stream_response, is_ready)
+
+    # initialize or display response field
+    if response_key not in st.session_state:
+        st.session_state[response_key] = ''
+    dynamic_height = calculate_text_area_height(st.session_state[response_key])
+    if st.session_state['current_page'] == page:
+        st.text_area("Response:", value=st.session_state[response_key], height=dynamic_height, key=f"response_field_{page}")
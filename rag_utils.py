@@ -0,0 +1,427 @@
+import os
+import hashlib
+import pickle
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from queue import Queue
+from typing import Any, Callable, List, Optional, Sequence, Tuple, cast
+
+import faiss
+from langchain.retrievers import EnsembleRetriever
+from langchain.retrievers.document_compressors import CohereRerank
+from langchain_community.llms import Replicate
+from langchain_community.document_loaders import OnlinePDFLoader
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_community.vectorstores import FAISS
+from langchain_community.embeddings import CohereEmbeddings
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.retrievers import BM25Retriever
+from langchain_core.callbacks import BaseCallbackHandler, CallbackManagerForRetrieverRun, Callbacks
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.outputs import LLMResult
+from langchain_core.runnables import RunnableConfig
+from langchain_core.runnables.config import patch_config
+
+
+LLAMA2_70B       = 'meta/llama-2-70b-chat:2d19859030ff705a87c746f7e96eea03aefb71f166725aee39692f1476566d48'
+EMBED_MODEL      = "embed-english-light-v3.0"
+MAX_LOAD_WORKERS = 8    # max number of PDFs downloaded and parsed concurrently
+CACHE_DIR        = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".rag_cache")
+MAX_CACHED_PDFS  = 64   # max number of parsed PDFs kept on disk, least recently used ones are removed first
+CACHE_VERSION    = 3    # bump whenever the layout of cached retrievers changes (index type, chunk metadata, ...)
+HNSW_M           = 32   # number of graph neighbors per vector in HNSW index
+HNSW_EF_SEARCH   = 64   # size of candidate list explored per query, keep above the number of fetched docs
+
+
+class QueueCallbackHandler(BaseCallbackHandler):
+    '''
+    Callback handler that puts new LLM tokens into a queue, so that a chain running in a background thread
+    can stream its response to a consumer. None is put into the queue as soon as the streaming LLM
+    finishes its answer, so the consumer does not wait for the rest of the chain (e.g. saving chat history).
+    LLM calls that do not stream tokens (e.g. rephrasing the question) do not end the stream.
+    '''
+    def __init__(self) -> None:
+        self.queue       = Queue()
+        self.has_tokens  = False    # set once the streaming LLM has generated its first token
+        self.answer_done = False    # set once the streaming LLM has finished its answer
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        self.has_tokens = True
+        self.queue.put(token)
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        if self.has_tokens and not self.answer_done:
+            self.answer_done = True
+            self.queue.put(None)    # signal end of stream
+
+
+class QueryCachingEmbeddings(Embeddings):
+    '''
+    Embeddings wrapper that remembers the embeddings of recent queries, so that a query is sent
+    to the embedding API only once even if several retrieval steps (or repeated questions) embed it.
+    Document embeddings are passed through to the wrapped embedding function unchanged.
+    '''
+    def __init__(self, embeddings: Embeddings, max_cached_queries: int = 128) -> None:
+        self.embeddings   = embeddings
+        self._embed_query = lru_cache(maxsize=max_cached_queries)(embeddings.embed_query)
+
+    def __getattr__(self, name: str) -> Any:
+        # look up wrapped embeddings in __dict__: during copy or unpickling it is not set yet,
+        # and self.embeddings would call __getattr__ again
+        embeddings = self.__dict__.get("embeddings")
+        if embeddings is None:
+            raise AttributeError(name)
+        return getattr(embeddings, name)    # expose attributes of wrapped embeddings, e.g. model
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return list(self._embed_query(text))    # copy, so that callers cannot modify the cached embedding
+
+
+class ConditionalCohereRerank(CohereRerank):
+    '''
+    CohereRerank that calls the Cohere Rerank API only if there are more candidate documents than top_n.
+    With few candidates reranking would return all of them anyway, so the API round trip is skipped
+    and the documents are returned in the order produced by the retriever.
+    '''
+    def compress_documents(
+            self,
+            documents: Sequence[Document],
+            query: str,
+            callbacks: Optional[Callbacks] = None,
+            ) -> Sequence[Document]:
+        '''
+        Rerank documents with Cohere Rerank API if there are more than top_n of them
+        Args:
+            documents (Sequence[Document]): candidate documents to rerank
+            query (str): query to rank the documents against
+            callbacks (Callbacks, optional): callbacks to run during reranking
+        Returns:
+            Sequence[Document]: at most top_n most relevant documents
+        '''
+        if len(documents) <= self.top_n:
+            return documents
+        return super().compress_documents(documents, query, callbacks=callbacks)
+
+
+class ParallelEnsembleRetriever(EnsembleRetriever):
+    '''
+    EnsembleRetriever that queries all its retrievers concurrently instead of one after another.
+    BM25 retrieval is local CPU work and FAISS retrieval waits for the query embedding from Cohere,
+    so the retrieval latency becomes that of the slowest retriever rather than the sum of all of them.
+    Rank fusion identifies documents by the integer doc_id in their metadata.
+    '''
+    def rank_fusion(
+            self,
+            query: str,
+            run_manager: CallbackManagerForRetrieverRun,
+            *,
+            config: Optional[RunnableConfig] = None,
+            ) -> List[Document]:
+        '''
+        Retrieve documents from all retrievers in parallel and fuse them with weighted Reciprocal Rank Fusion
+        Args:
+            query (str): query to search for
+            run_manager (CallbackManagerForRetrieverRun): callback manager of the current run
+            config (RunnableConfig, optional): config of the current run, passed on to the retrievers
+        Returns:
+            List[Document]: fused list of documents sorted by their RRF scores
+        '''
+        # get the results of all retrievers concurrently
+        with ThreadPoolExecutor(max_workers=len(self.retrievers)) as executor:
+            futures = [
+                executor.submit(
+                    retriever.invoke,
+                    query,
+                    patch_config(config, callbacks=run_manager.get_child(tag=f"retriever_{i+1}")),
+                )
+                for i, retriever in enumerate(self.retrievers)
+            ]
+            retriever_docs = [future.result() for future in futures]
+
+        # enforce that retrieved docs are Documents for each list in retriever_docs
+        for i in range(len(retriever_docs)):
+            retriever_docs[i] = [
+                Document(page_content=cast(str, doc)) if isinstance(doc, str) else doc
+                for doc in retriever_docs[i]
+            ]
+
+        # apply rank fusion
+        return self.weighted_reciprocal_rank(retriever_docs)
+
+    def weighted_reciprocal_rank(self, doc_lists: List[List[Document]]) -> List[Document]:
+        '''
+        Fuse ranked lists of documents with weighted Reciprocal Rank Fusion: score = sum(weight / (c + rank)).
+        Documents are identified by the integer doc_id assigned to each chunk on ingestion
+        instead of hashing their full text.
+        Args:
+            doc_lists (List[List[Document]]): ranked lists of documents, one per retriever
+        Returns:
+            List[Document]: unique documents sorted by their RRF scores in descending order
+        '''
+        if len(doc_lists) != len(self.weights):
+            raise ValueError("Number of rank lists must be equal to the number of weights.")
+
+        rrf_scores = defaultdict(float)
+        docs_by_id = {}
+        for doc_list, weight in zip(doc_lists, self.weights):
+            for rank, doc in enumerate(doc_list, start=1):
+                doc_id = doc.metadata["doc_id"]
+                rrf_scores[doc_id] += weight / (self.c + rank)
+                docs_by_id.setdefault(doc_id, doc)
+        return [docs_by_id[doc_id] for doc_id in sorted(rrf_scores, key=rrf_scores.get, reverse=True)]
+
+
+def get_default_embed_func() -> Embeddings:
+    '''
+    Create the Cohere embedding function used to embed document chunks and user queries;
+    embeddings of recent queries are cached, so each query is embedded only once
+    '''
+    return QueryCachingEmbeddings(CohereEmbeddings(model=EMBED_MODEL))
+
+
+def get_default_llm(streaming: bool = False) -> Replicate:
+    '''
+    Create the Llama 2 model client with specific parameters
+    Args:
+        streaming (bool, optional): whether the client reports generated tokens to callbacks, defaults to False
+    '''
+    return Replicate(
+        model=LLAMA2_70B,
+        model_kwargs={"temperature": 0.5,"top_p": 1, "max_new_tokens":1000},
+        streaming=streaming,
+    )
+
+
+def get_default_reranker() -> CohereRerank:
+    '''
+    Create the Cohere reranker used to improve retrieval quality; reranking is skipped for 5 or fewer candidates
+    '''
+    return ConditionalCohereRerank(top_n=5)
+
+
+def prune_pdf_cache(pdf_dir: str, max_cached_pdfs: int) -> None:
+    '''
+    Remove least recently used parsed PDFs from disk cache, so that at most max_cached_pdfs of them are kept
+    Args:
+        pdf_dir (str): directory of the cached PDF documents
+        max_cached_pdfs (int): max number of cached PDF documents
+    '''
+    pdf_paths = [os.path.join(pdf_dir, name) for name in os.listdir(pdf_dir) if name.endswith(".pkl")]
+    if len(pdf_paths) <= max_cached_pdfs:
+        return
+    mtimes = {}
+    for pdf_path in pdf_paths:
+        try:
+            mtimes[pdf_path] = os.path.getmtime(pdf_path)
+        except FileNotFoundError:    # removed by a concurrent load
+            pass
+    for pdf_path in sorted(mtimes, key=mtimes.get)[:len(mtimes) - max_cached_pdfs]:
+        try:
+            os.remove(pdf_path)
+        except FileNotFoundError:
+            pass
+
+
+def load_pdf(url: str) -> Document:
+    '''
+    Download and parse a single PDF document. Parsed documents are cached on disk by URL,
+    so reloading the same PDF is instant even after the app restarts; the cache keeps
+    the MAX_CACHED_PDFS most recently used documents
+    Args:
+        url (str): URL pointing to the PDF document
+    Returns:
+        Document: loaded PDF document
+    '''
+    pdf_dir  = os.path.join(CACHE_DIR, "pdfs")
+    pdf_path = os.path.join(pdf_dir, f"{hashlib.sha256(url.encode('utf-8')).hexdigest()}.pkl")
+    try:
+        with open(pdf_path, "rb") as f:
+            doc = pickle.load(f)
+        os.utime(pdf_path)    # mark as recently used, so it is pruned last
+        return doc
+    except FileNotFoundError:
+        pass
+    except Exception as e:    # corrupted cache entry - load PDF again
+        print(f"Could not load PDF from cache: {e}")
+
+    doc = OnlinePDFLoader(url).load()[0]
+    try:
+        os.makedirs(pdf_dir, exist_ok=True)
+        with open(f"{pdf_path}.tmp", "wb") as f:
+            pickle.dump(doc, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f"{pdf_path}.tmp", pdf_path)
+        prune_pdf_cache(pdf_dir, MAX_CACHED_PDFS)
+    except Exception as e:    # e.g. disk full or no write permission - PDF is already loaded
+        print(f"Could not save PDF to cache: {e}")
+    return doc
+
+
+def load_pdfs(
+        pdf_links: List,
+        pdf_loader: Callable[[str], Document] = load_pdf,
+        progress_callback: Optional[Callable[[int, int], None]] = None,
+        ) -> List[Document]:
+    '''
+    Load PDF documents in parallel - download and parsing are dominated by network I/O
+    Args:
+        pdf_links (List): list of URLs pointing to the PDF documents to be loaded
+        pdf_loader (Callable, optional): function loading a single PDF document, defaults to load_pdf
+        progress_callback (Callable, optional): called with (number of loaded PDFs, total number of PDFs)
+            each time a PDF finishes loading
+    Returns:
+        List[Document]: loaded PDF documents in the order of pdf_links
+    '''
+    raw_data = [None] * len(pdf_links)
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_LOAD_WORKERS, len(pdf_links)))) as executor:
+        futures = {executor.submit(pdf_loader, url): i for i, url in enumerate(pdf_links)}
+        for n_done, future in enumerate(as_completed(futures), start=1):
+            raw_data[futures[future]] = future.result()    # keep original order of PDFs
+            if progress_callback is not None:
+                progress_callback(n_done, len(pdf_links))
+    return raw_data
+
+
+def build_hnsw_vector_store(
+        texts: List[str],
+        embeddings: List[List[float]],
+        metadatas: List[dict],
+        embed_func: Embeddings,
+        ) -> FAISS:
+    '''
+    Build a FAISS vector store backed by an HNSW graph index instead of the default flat index,
+    so that queries visit a neighborhood of the graph rather than scanning every vector
+    Args:
+        texts (List[str]): text chunks
+        embeddings (List[List[float]]): precomputed embeddings of the text chunks
+        metadatas (List[dict]): metadata of the text chunks
+        embed_func (Embeddings): embedding function used to embed user queries
+    Returns:
+        FAISS: vector store containing the text chunks
+    '''
+    index = faiss.IndexHNSWFlat(len(embeddings[0]), HNSW_M)    # HNSW needs no training
+    index.hnsw.efSearch = HNSW_EF_SEARCH
+    vector_store = FAISS(embed_func, index, InMemoryDocstore(), {})
+    vector_store.add_embeddings(list(zip(texts, embeddings)), metadatas=metadatas)
+    return vector_store
+
+
+def get_cache_key(pdf_links: List, chunk_size: int, embed_model: str) -> str:
+    '''
+    Build a cache key identifying the retrievers built for a set of PDF documents
+    Args:
+        pdf_links (List): list of URLs pointing to the PDF documents
+        chunk_size (int): size of text chunks the documents are split into
+        embed_model (str): name of the model used to embed the text chunks
+    Returns:
+        str: SHA-256 hex digest of the cache version, sorted URLs, chunk size, and embedding model
+    '''
+    key = "\n".join([f"v{CACHE_VERSION}"] + sorted(pdf_links) + [str(chunk_size), embed_model])
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def load_retrievers_from_cache(
+        cache_key: str,
+        embed_func: Embeddings,
+        ) -> Optional[Tuple[BM25Retriever, FAISS]]:
+    '''
+    Load a BM25 retriever and a FAISS vector store previously saved to disk
+    Args:
+        cache_key (str): cache key returned by get_cache_key
+        embed_func (Embeddings): embedding function used to embed user queries
+    Returns:
+        Optional[Tuple[BM25Retriever, FAISS]]: cached BM25 retriever and FAISS vector store,
+            None if they are not cached
+    '''
+    bm25_path  = os.path.join(CACHE_DIR, f"bm25_{cache_key}.pkl")
+    faiss_path = os.path.join(CACHE_DIR, f"faiss_{cache_key}")
+    if not (os.path.isfile(bm25_path) and os.path.isdir(faiss_path)):
+        return None
+    try:
+        with open(bm25_path, "rb") as f:
+            bm25_retriever = pickle.load(f)
+        vector_store = FAISS.load_local(faiss_path, embed_func)
+    except Exception as e:    # corrupted or incompatible cache - rebuild retrievers
+        print(f"Could not load retrievers from cache: {e}")
+        return None
+    return bm25_retriever, vector_store
+
+
+def save_retrievers_to_cache(
+        cache_key: str,
+        bm25_retriever: BM25Retriever,
+        vector_store: FAISS,
+        ) -> None:
+    '''
+    Save a BM25 retriever and a FAISS vector store to disk; failing to save only means they are not cached
+    Args:
+        cache_key (str): cache key returned by get_cache_key
+        bm25_retriever (BM25Retriever): BM25 retriever to be saved
+        vector_store (FAISS): FAISS vector store to be saved
+    '''
+    bm25_path = os.path.join(CACHE_DIR, f"bm25_{cache_key}.pkl")
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        vector_store.save_local(os.path.join(CACHE_DIR, f"faiss_{cache_key}"))
+        # save BM25 retriever last and atomically: it marks the cache entry as complete
+        with open(f"{bm25_path}.tmp", "wb") as f:
+            pickle.dump(bm25_retriever, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f"{bm25_path}.tmp", bm25_path)
+    except Exception as e:    # e.g. disk full or no write permission - retrievers are already built
+        print(f"Could not save retrievers to cache: {e}")
+
+
+def build_retrievers(
+        pdf_links: List,
+        chunk_size: int,
+        embed_func: Embeddings,
+        pdf_loader: Callable[[str], Document] = load_pdf,
+        progress_callback: Optional[Callable[[int, int], None]] = None,
+        ) -> Tuple[BM25Retriever, FAISS, List[Document]]:
+    '''
+    Load, chunk, and index PDF documents into a BM25 retriever and a FAISS vector store.
+    Both are cached on disk and reused when the same PDFs are processed again.
+    Args:
+        pdf_links (List): list of URLs pointing to the PDF documents to be processed
+        chunk_size (int): size of text chunks to split the documents into
+        embed_func (Embeddings): embedding function used to embed the text chunks
+        pdf_loader (Callable, optional): function loading a single PDF document, defaults to load_pdf
+        progress_callback (Callable, optional): called with (number of loaded PDFs, total number of PDFs)
+            each time a PDF finishes loading
+    Returns:
+        Tuple[BM25Retriever, FAISS, List[Document]]: BM25 retriever, FAISS vector store, and text chunks
+    '''
+    # reuse BM25 retriever and vector store saved to disk if the same PDFs were processed before
+    embed_model = getattr(embed_func, "model", type(embed_func).__name__)
+    cache_key = get_cache_key(pdf_links, chunk_size, embed_model)
+    cached_retrievers = load_retrievers_from_cache(cache_key, embed_func)
+    if cached_retrievers is not None:
+        bm25_retriever, vector_store = cached_retrievers
+        print("Loaded BM25 retriever and vectore store from cache.")
+        return bm25_retriever, vector_store, bm25_retriever.docs
+
+    # load pdfs in parallel
+    raw_data = load_pdfs(pdf_links, pdf_loader, progress_callback)
+
+    # chunk text sequentially: a ~250k-character pdf splits in ~11 ms, less than starting a process pool,
+    # and forking worker processes from the multi-threaded Streamlit server can deadlock
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=100)
+    split_data    = text_splitter.split_documents(raw_data)
+    for i, doc in enumerate(split_data):    # integer ids identify chunks during rank fusion
+        doc.metadata["doc_id"] = i
+
+    # add chunks to BM25 retriever
+    bm25_retriever = BM25Retriever.from_documents(split_data)
+
+    # embed all chunks in a single embed_documents call (Cohere client sends them in batches of 96 texts)
+    # and add the precomputed embeddings to vectore store with HNSW index
+    texts        = [doc.page_content for doc in split_data]
+    metadatas    = [doc.metadata for doc in split_data]
+    embeddings   = embed_func.embed_documents(texts)
+    vector_store = build_hnsw_vector_store(texts, embeddings, metadatas, embed_func)
+    save_retrievers_to_cache(cache_key, bm25_retriever, vector_store)
+    return bm25_retriever, vector_store, split_data
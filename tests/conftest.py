@@ -0,0 +1,5 @@
+import os
+import sys
+
+# make modules in repository root (advanced_rag, rag_utils, ...) importable when running plain `pytest`
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,111 @@
+import threading
+from typing import Any, Dict, List, Optional, Sequence
+
+import pytest
+from langchain.retrievers.document_compressors.base import BaseDocumentCompressor
+from langchain_community.embeddings import FakeEmbeddings
+from langchain_core.callbacks import CallbackManagerForLLMRun, Callbacks
+from langchain_core.documents import Document
+from langchain_core.language_models.llms import LLM
+
+import rag_utils
+from advanced_rag_history import CharBudgetSummaryBufferMemory, ElevatedRagWithHistory
+
+
+ANSWER = "Llama 2 is a family of pretrained and fine-tuned LLMs."
+
+
+class StubLLM(LLM):
+    '''
+    LLM returning a fixed answer; reports the answer tokens to callbacks if streaming is enabled
+    '''
+    answer: str = ANSWER
+    streaming: bool = False
+
+    @property
+    def _llm_type(self) -> str:
+        return "stub"
+
+    def _call(
+            self,
+            prompt: str,
+            stop: Optional[List[str]] = None,
+            run_manager: Optional[CallbackManagerForLLMRun] = None,
+            **kwargs: Any,
+            ) -> str:
+        if self.streaming and run_manager is not None:
+            for token in self.answer.split(" "):
+                run_manager.on_llm_new_token(token + " ")
+        return self.answer
+
+
+class StubReranker(BaseDocumentCompressor):
+    '''
+    Reranker keeping the first top_n documents without calling the Cohere API
+    '''
+    top_n: int = 5
+
+    def compress_documents(
+            self,
+            documents: Sequence[Document],
+            query: str,
+            callbacks: Optional[Callbacks] = None,
+            ) -> Sequence[Document]:
+        return documents[:self.top_n]
+
+
+def load_stub_pdf(url: str) -> Document:
+    text = " ".join(f"Paragraph {i} of {url} about Llama 2 models and their fine-tuning." for i in range(200))
+    return Document(page_content=text, metadata={"source": url})
+
+
+@pytest.fixture
+def rag(tmp_path, monkeypatch) -> ElevatedRagWithHistory:
+    monkeypatch.setattr(rag_utils, "CACHE_DIR", str(tmp_path))
+    rag = ElevatedRagWithHistory(
+        embed_func=FakeEmbeddings(size=32),
+        llm=StubLLM(),
+        streaming_llm=StubLLM(streaming=True),
+        reranker=StubReranker(),
+        pdf_loader=load_stub_pdf,
+    )
+    rag.add_pdfs_to_vectore_store(["https://example.com/a.pdf", "https://example.com/b.pdf"])
+    return rag
+
+
+def test_invoke_returns_answer_and_updates_history(rag):
+    assert rag.invoke("What is Llama 2?") == ANSWER
+    assert rag.invoke("How was it fine-tuned?") == ANSWER
+    assert len(rag.memory.chat_memory.messages) == 4
+
+
+def test_stream_yields_answer_tokens(rag):
+    assert "".join(rag.stream("What is Llama 2?")).strip() == ANSWER
+    # rephrasing the question on the second turn uses the non-streaming LLM, so only answer tokens are streamed
+    assert "".join(rag.stream("How was it fine-tuned?")).strip() == ANSWER
+    rag.chain_thread.join()
+    assert len(rag.memory.chat_memory.messages) == 4
+
+
+def test_stream_ends_before_history_is_saved(rag, monkeypatch):
+    release_save = threading.Event()
+    save_context  = CharBudgetSummaryBufferMemory.save_context
+
+    def slow_save_context(self, inputs: Dict[str, Any], outputs: Dict[str, str]) -> None:
+        release_save.wait(timeout=10)
+        save_context(self, inputs, outputs)
+    monkeypatch.setattr(CharBudgetSummaryBufferMemory, "save_context", slow_save_context)
+
+    assert "".join(rag.stream("What is Llama 2?")).strip() == ANSWER
+    assert rag.chain_thread.is_alive()
+    release_save.set()
+    rag.chain_thread.join()
+    assert len(rag.memory.chat_memory.messages) == 2
+
+
+def test_stream_reraises_chain_errors(rag, monkeypatch):
+    def fail(*args: Any, **kwargs: Any) -> None:
+        raise RuntimeError("boom")
+    monkeypatch.setattr(StubLLM, "_call", fail)
+    with pytest.raises(RuntimeError, match="boom"):
+        list(rag.stream("What is Llama 2?"))
@@ -0,0 +1,139 @@
+import copy
+import hashlib
+import os
+from typing import List, Optional, Sequence
+
+import pytest
+from langchain.retrievers.document_compressors import CohereRerank
+from langchain_community.embeddings import FakeEmbeddings
+from langchain_community.retrievers import BM25Retriever
+from langchain_core.callbacks import Callbacks
+from langchain_core.documents import Document
+
+import rag_utils
+from rag_utils import ConditionalCohereRerank, ParallelEnsembleRetriever, QueryCachingEmbeddings, load_pdf
+
+
+def make_docs(n: int) -> List[Document]:
+    return [Document(page_content=f"chunk {i}", metadata={"doc_id": i}) for i in range(n)]
+
+
+@pytest.fixture
+def cohere_calls(monkeypatch) -> List[str]:
+    '''
+    Replace the Cohere Rerank API call with a stub reversing the documents; returns the queries it was called with
+    '''
+    calls = []
+
+    def rerank(
+            self,
+            documents: Sequence[Document],
+            query: str,
+            callbacks: Optional[Callbacks] = None,
+            ) -> Sequence[Document]:
+        calls.append(query)
+        return list(reversed(documents))[:self.top_n]
+    monkeypatch.setattr(CohereRerank, "compress_documents", rerank)
+    return calls
+
+
+@pytest.mark.parametrize("n_docs", [0, 2, 3])
+def test_conditional_rerank_passes_through_few_documents(cohere_calls, n_docs):
+    reranker = ConditionalCohereRerank(top_n=3, cohere_api_key="test-key")
+    docs = make_docs(n_docs)
+    assert reranker.compress_documents(docs, "query") == docs
+    assert cohere_calls == []
+
+
+def test_conditional_rerank_calls_cohere_for_more_than_top_n_documents(cohere_calls):
+    reranker = ConditionalCohereRerank(top_n=3, cohere_api_key="test-key")
+    docs = make_docs(5)
+    assert reranker.compress_documents(docs, "query") == [docs[4], docs[3], docs[2]]
+    assert cohere_calls == ["query"]
+
+
+class CountingEmbeddings(FakeEmbeddings):
+    '''
+    Fake embeddings counting the queries sent to the embedding API
+    '''
+    model: str = "counting"
+    n_queries: int = 0
+
+    def embed_query(self, text: str) -> List[float]:
+        self.n_queries += 1
+        return super().embed_query(text)
+
+
+def test_query_caching_embeddings_embeds_each_query_once():
+    embeddings = QueryCachingEmbeddings(CountingEmbeddings(size=8))
+    first = embeddings.embed_query("What is Llama 2?")
+    first.append(0.0)    # modifying the returned embedding must not change the cached one
+    assert embeddings.embed_query("What is Llama 2?") == first[:-1]
+    embeddings.embed_query("How was it fine-tuned?")
+    assert embeddings.embeddings.n_queries == 2
+    assert embeddings.model == "counting"
+
+
+def test_query_caching_embeddings_can_be_copied():
+    embeddings = QueryCachingEmbeddings(CountingEmbeddings(size=8))
+    embeddings_copy = copy.copy(embeddings)
+    assert embeddings_copy.model == "counting"
+    with pytest.raises(AttributeError):
+        QueryCachingEmbeddings.__new__(QueryCachingEmbeddings).model
+
+
+class StubPDFLoader:
+    '''
+    OnlinePDFLoader replacement counting the PDFs it downloads
+    '''
+    n_loads = 0
+
+    def __init__(self, url: str) -> None:
+        self.url = url
+
+    def load(self) -> List[Document]:
+        StubPDFLoader.n_loads += 1
+        return [Document(page_content=f"text of {self.url}", metadata={"source": self.url})]
+
+
+def test_load_pdf_caches_documents_and_keeps_most_recently_used(tmp_path, monkeypatch):
+    monkeypatch.setattr(rag_utils, "CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(rag_utils, "MAX_CACHED_PDFS", 2)
+    monkeypatch.setattr(rag_utils, "OnlinePDFLoader", StubPDFLoader)
+    monkeypatch.setattr(StubPDFLoader, "n_loads", 0)
+
+    def cached_pdf_path(url: str) -> str:
+        return os.path.join(tmp_path, "pdfs", f"{hashlib.sha256(url.encode('utf-8')).hexdigest()}.pkl")
+
+    load_pdf("a.pdf")
+    load_pdf("b.pdf")
+    os.utime(cached_pdf_path("a.pdf"), (1, 1))
+    os.utime(cached_pdf_path("b.pdf"), (2, 2))
+    assert load_pdf("a.pdf").page_content == "text of a.pdf"    # cache hit marks a.pdf as recently used
+    assert StubPDFLoader.n_loads == 2
+
+    load_pdf("c.pdf")    # b.pdf is now the least recently used document and is removed
+    assert StubPDFLoader.n_loads == 3
+    assert os.path.exists(cached_pdf_path("a.pdf"))
+    assert not os.path.exists(cached_pdf_path("b.pdf"))
+    assert os.path.exists(cached_pdf_path("c.pdf"))
+
+
+@pytest.fixture
+def ensemble_retriever() -> ParallelEnsembleRetriever:
+    retrievers = [BM25Retriever.from_documents(make_docs(1)), BM25Retriever.from_documents(make_docs(1))]
+    return ParallelEnsembleRetriever(retrievers=retrievers, weights=[0.6, 0.4])
+
+
+def test_rank_fusion_sorts_by_weighted_rrf_score_and_dedupes_by_doc_id(ensemble_retriever):
+    docs = make_docs(4)
+    # same chunk id with different text, e.g. whitespace normalized by one of the retrievers
+    doc_2_copy = Document(page_content="chunk 2 ", metadata={"doc_id": 2})
+    fused = ensemble_retriever.weighted_reciprocal_rank([[docs[0], docs[1], docs[2]], [doc_2_copy, docs[3]]])
+    # scores with c=60: doc 2 = 0.6/63 + 0.4/61, doc 0 = 0.6/61, doc 1 = 0.6/62, doc 3 = 0.4/62
+    assert fused == [docs[2], docs[0], docs[1], docs[3]]
+
+
+def test_rank_fusion_rejects_weight_count_mismatch(ensemble_retriever):
+    with pytest.raises(ValueError):
+        ensemble_retriever.weighted_reciprocal_rank([make_docs(2)])